@@ -1,9 +1,9 @@
 #!/usr/bin/env bash
 # =============================================================================
-# Export Odoo 18 CRM to CSV via XML-RPC API
+# Export Odoo 18 CRM to CSV via JSON-RPC API
 # Starts Odoo automatically if not running, then runs export_crm_api.py.
 # If Odoo was started by this script it will be stopped afterwards.
-# Usage: sudo ./export_crm_api.sh [output_file.csv]
+# Usage: sudo ./export_crm_api.sh [output_file.csv | output_file.csv.gz]
 # =============================================================================
 
 set -e
@@ -0,0 +1,191 @@
+# =============================================================================
+# Row formatting for export_crm_api.py: turns crm.lead records read over
+# JSON-RPC into CSV lines. Kept in its own module so the row worker processes
+# import it cleanly, and so it can be compiled to a C extension with mypyc:
+#     python3.11 -m pip install mypy && mypyc export_crm_rows.py
+# Python imports the compiled module in preference to this file when present;
+# without it everything runs as plain Python with identical output.
+# =============================================================================
+
+import re
+import unicodedata
+from operator import itemgetter
+from typing import Any, Iterable, Iterator, Literal
+
+# Fields to fetch from crm.lead
+FIELDS = [
+    "id", "name", "type", "active", "probability",
+    "expected_revenue", "recurring_revenue", "priority",
+    "date_deadline", "date_open", "date_closed", "date_conversion",
+    "create_date", "write_date",
+    "stage_id",
+    "partner_id",
+    "email_from", "phone", "mobile",
+    "street", "city", "zip", "country_id",
+    "partner_name",
+    "user_id",
+    "team_id",
+    "tag_ids",
+    "lost_reason_id",
+    "campaign_id", "medium_id", "source_id",
+]
+
+HEADERS = [
+    "id", "opportunity_name", "type", "active", "probability",
+    "expected_revenue", "recurring_revenue", "priority",
+    "date_deadline", "date_open", "date_closed", "date_conversion",
+    "create_date", "write_date",
+    "stage_name", "stage_sequence",
+    "partner_name", "partner_email", "partner_phone", "partner_mobile",
+    "partner_street", "partner_city", "partner_zip", "partner_country",
+    "lead_contact_name",
+    "email_from", "phone", "mobile",
+    "street", "city", "zip", "lead_country",
+    "assigned_user_login", "assigned_user_name",
+    "sales_team",
+    "tags",
+    "lost_reason",
+    "campaign", "medium", "source",
+]
+
+# Pulls all FIELDS out of a record as one tuple in a single C call
+_lead_values = itemgetter(*FIELDS)
+
+# Stage, user, team, country and tag names repeat on nearly every row, so the
+# normalised form of each distinct string is computed once. Bounded so that
+# high-cardinality fields (names, emails) cannot grow it without limit.
+_nfc_cache: dict[str, str] = {}
+_NFC_CACHE_SIZE = 100_000
+
+def nfc(v: str) -> str:
+    """Normalise unicode to NFC (composed form) and strip, so Spanish accented
+    characters are stored as single code points, not decomposed sequences.
+    Ensures correct display in Excel and LibreOffice.
+    """
+    # NFC is the identity on ASCII, which most cells (ids, emails, phones,
+    # dates) are; isascii() is a single C pass, far cheaper than normalize()
+    if v.isascii():
+        return v.strip()
+    cached = _nfc_cache.get(v)
+    if cached is None:
+        cached = unicodedata.normalize("NFC", v).strip()
+        if len(_nfc_cache) >= _NFC_CACHE_SIZE:
+            del _nfc_cache[next(iter(_nfc_cache))]  # evict oldest
+        _nfc_cache[v] = cached
+    return cached
+
+# The schema is fixed, so each column knows its own shape: Odoo returns False
+# for an empty field, a string for char/selection/date fields and an
+# [id, name] pair for many2one fields. One helper per shape avoids the
+# isinstance() dispatch a generic flatten would pay on every cell.
+def _str(v: str | Literal[False]) -> str:
+    """Char, selection or date field: str or False."""
+    return nfc(v) if v else ""
+
+def _m2o_name(v: list[Any] | Literal[False]) -> str:
+    """Display name of a many2one field: [id, name] or False."""
+    return nfc(v[1]) if v else ""
+
+_needs_quote = re.compile(r'[",\r\n]').search
+
+def _q(v: str) -> str:
+    """Quote one text field exactly as csv.writer's default (excel) dialect.
+    The schema is fixed, so rows are joined directly instead of paying
+    csv.writer's per-field dispatch.
+    """
+    if _needs_quote(v):
+        return '"' + v.replace('"', '""') + '"'
+    return v
+
+def build_rows(records: list[dict[str, Any]],
+               tag_name_map: dict[int, str],
+               partner_map: dict[int, dict[str, Any]],
+               stage_map: dict[int, int],
+               user_login_map: dict[int, str]) -> str:
+    """Format a chunk of lead records as CSV text, one line per record in
+    HEADERS order. Runs in a row worker process, so it only touches its
+    arguments and the pure helpers above.
+
+    Works column by column (struct of arrays): the records are transposed
+    once, each column is converted with map(), and the columns are zipped
+    back into rows, so the per-cell loops run inside map()/zip() rather than
+    as Python statements per record.
+    """
+    if not records:
+        return ""
+    # Transpose in C: itemgetter yields one tuple per record, zip(*) turns
+    # them into one tuple per field, unpacked straight into locals.
+    (rid, name, type_, active, prob, expected, recurring, priority,
+     dl, do, dc, dcv, cd, wd,
+     stage, partner_id,
+     email, phone, mobile, street, city, zipc, country,
+     pname, user, team, tag_ids, lost, camp, med, src) = zip(*map(_lead_values, records))
+
+    partners    = [partner_map.get(v[0], {}) if v else {} for v in partner_id]
+    stage_seq   = [stage_map.get(v[0], "") if v else "" for v in stage]
+    user_login  = [user_login_map.get(v[0], "") if v else "" for v in user]
+    tag_names   = [" | ".join([tag_name_map.get(tid, "") for tid in v]) if v else ""
+                   for v in tag_ids]
+    probability = [f"{v:.10g}" if v is not False else "" for v in prob]
+
+    # Leads without a partner get False, like any other empty Odoo field
+    def partner(field: str) -> list[Any]:
+        return [p.get(field, False) for p in partners]
+
+    # Only free-text columns can hold a quote, comma or newline, so only
+    # those go through _q(); ids, numbers, dates and selection keys are
+    # plain str(), the same bytes csv.writer would emit for them.
+    def text(values: Iterable[str]) -> Iterator[str]:
+        return map(_q, values)
+
+    columns = (
+        map(str, rid),
+        text(map(_str, name)),
+        map(_str, type_),
+        map(str, active),
+        probability,
+        map(str, expected),
+        map(str, recurring),
+        map(_str, priority),
+        map(_str, dl),
+        map(_str, do),
+        map(_str, dc),
+        map(_str, dcv),
+        map(_str, cd),
+        map(_str, wd),
+        # stage
+        text(map(_m2o_name, stage)),
+        map(str, stage_seq),
+        # partner (from partner record)
+        text(map(_m2o_name, partner_id)),
+        text(map(_str, partner("email"))),
+        text(map(_str, partner("phone"))),
+        text(map(_str, partner("mobile"))),
+        text(map(_str, partner("street"))),
+        text(map(_str, partner("city"))),
+        text(map(_str, partner("zip"))),
+        text(map(_m2o_name, partner("country_id"))),
+        # lead contact fields
+        text(map(_str, pname)),
+        text(map(_str, email)),
+        text(map(_str, phone)),
+        text(map(_str, mobile)),
+        text(map(_str, street)),
+        text(map(_str, city)),
+        text(map(_str, zipc)),
+        text(map(_m2o_name, country)),
+        # user
+        text(user_login),
+        text(map(_m2o_name, user)),
+        # team
+        text(map(_m2o_name, team)),
+        # tags
+        text(tag_names),
+        # lost reason
+        text(map(_m2o_name, lost)),
+        # UTM
+        text(map(_m2o_name, camp)),
+        text(map(_m2o_name, med)),
+        text(map(_m2o_name, src)),
+    )
+    return "".join([",".join(row) + "\r\n" for row in zip(*columns)])